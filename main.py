@@ -1,24 +1,68 @@
-from collections import defaultdict
+from functools import lru_cache
 from datetime import datetime
 import os
+import re
 import shutil
 import sys
 from pathlib import Path
+from typing import Iterator
 from getpass import getpass
-from json import JSONDecodeError, dump, dumps, load
-import traceback
+from json import dumps, loads
+try:
+    import orjson
+    ORJSON_OPTION = orjson.OPT_INDENT_2
+except ImportError:
+    orjson = None
 
 
 BOT_NAME = '[WingedSeal-Bot] '
 INDENT_LV = 4
+TEMP_SUFFIX = '.wingedseal-tmp'
 DEFAULTS = {
     "pack_format": 8,
     "description": "Fixed by WingedSeal-Bot"
 }
+NAMESPACE = re.compile(r'[a-z0-9_.-]+:')
+INVALID_NAME_CHAR = re.compile(r'[^a-z0-9_./-]')
+MODEL_PREFIX = 'assets/minecraft/models/'
+ITEM_PREFIX = MODEL_PREFIX+'item/'
+TEXTURE_PREFIX = 'assets/minecraft/textures/'
 AUTO_FIX = False
 is_error_exist = False
 
 
+def _loads(data: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return loads(data)
+
+
+def is_utf8(data: bytes) -> bool:
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _dumps(json: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(json, option=ORJSON_OPTION)
+    return dumps(json, indent=INDENT_LV).encode()
+
+
+def write_json(file_path: Path, json: dict) -> None:
+    # Write next to the file and swap it in, so a crash never leaves it half-written
+    temp_path = file_path.with_name(file_path.name+TEMP_SUFFIX)
+    temp_path.write_bytes(_dumps(json))
+    os.replace(temp_path, file_path)
+
+
+@lru_cache(maxsize=None)
+def display_path(file_path: Path) -> str:
+    return file_path.resolve().as_posix()
+
+
 class NoQuickFix(Exception):
     pass
 
@@ -45,164 +89,261 @@ def ask(question: str) -> bool:
                 BOT_NAME+"I can't understand your answer, please type either 'yes' or 'no'.")
 
 
-def fix_name(string: str) -> tuple[bool, str]:
-    if string.islower() and ' ' not in string and (string.isalnum() or any(char in string for char in ['.', '/', '_'])):
+@lru_cache(maxsize=4096)
+def _fix_name(string: str) -> tuple[bool, str]:
+    namespace = NAMESPACE.match(string)
+    prefix = namespace.group() if namespace else ''
+    name = string[len(prefix):]
+    if not INVALID_NAME_CHAR.search(name):
         return (False, string)
-    if ask(f"I found invalid file name({string}). I can fix that for you right now."):
-        string = string.replace(' ', '_').replace(
-            '-', '_').replace('&', 'and').lower()
-        string = "".join(char if (char.isalnum() or char in ['.', '/', '_']) else str(ord(char))
-                         for char in string)
-        return True, string
+    fixed = name.replace(' ', '_').replace('&', 'and').lower()
+    fixed = INVALID_NAME_CHAR.sub(
+        lambda match: str(ord(match.group())), fixed)
+    return (True, prefix+fixed)
+
+
+def fix_name(string: str) -> tuple[bool, str]:
+    is_invalid, fixed = _fix_name(string)
+    if is_invalid and ask(f"I found invalid file name({string}). I can fix that for you right now."):
+        return True, fixed
     return False, string
 
 
 def check_pack_mcmeta(path: Path) -> None:
     DEFAULT_JSON = {"pack": {
                     "pack_format": DEFAULTS["pack_format"], "description": DEFAULTS["description"]}}
-    with (path/'pack.mcmeta').open('r') as file:
-        try:
-            json = load(file)
-        except JSONDecodeError:
-            if ask("I found an error in JSON format of `pack.mcmeta`. I can reset it."):
-                with (path/'pack.mcmeta').open('w+') as file:
-                    dump(DEFAULT_JSON, file, indent=INDENT_LV)
-                return
-        if 'pack' not in json:
-            if ask("I can't find `pack` keyword in `pack.mcmeta`. I can reset it."):
-                with (path/'pack.mcmeta').open('w+') as file:
-                    dump(DEFAULT_JSON, file, indent=INDENT_LV)
-                return
-        if "pack_format" not in json['pack']:
-            if ask(f"I can't find `pack_format` keyword in `pack.mcmeta`. I can set it to {DEFAULTS['pack_format']}"):
-                json['pack']['pack_format'] = DEFAULTS['pack_format']
-        else:
-            try:
-                assert type(json['pack']['pack_format']) == int
-            except (ValueError, AssertionError):
-                if ask(f"`pack_format` in `pack.mcmeta` should be a whole number. I can set it to {DEFAULTS['pack_format']}"):
-                    json['pack']['pack_format'] = DEFAULTS['pack_format']
-
-        if "description" not in json['pack']:
-            if ask(f"I can't find `description` keyword in `pack.mcmeta`. I can set it to {DEFAULTS['description']}"):
-                json['pack']['description'] = DEFAULTS['description']
-        with (path/'pack.mcmeta').open('w+') as file:
-            dump(json, file, indent=INDENT_LV)
-
-
-def check_non_json(file_path: Path) -> None:
-    if file_path.suffix != '.json':
-        if ask(f"I found `{file_path.name}` file which isn't json file. Would you like me to change that?"):
-            if file_path.stem.endswith(".json"):
-                file_path = file_path.rename(
-                    Path(file_path.parent, file_path.stem))
-            else:
-                file_path = file_path.rename(
-                    Path(file_path.parent, file_path.stem+'.json'))
-
-
-def check_non_png(file_path: Path) -> None:
-    if file_path.suffix != '.png':
-        if ask(f"I found `{file_path.name}` file which isn't png file. Would you like me to change that?"):
-            if file_path.stem.endswith(".json"):
-                file_path = file_path.rename(
-                    Path(file_path.parent, file_path.stem))
-            else:
-                file_path = file_path.rename(
-                    Path(file_path.parent, file_path.stem+'.png'))
+    pack_mcmeta = path/'pack.mcmeta'
+    is_dirty = False
+    data = pack_mcmeta.read_bytes()
+    try:
+        json = _loads(data)
+    except ValueError:
+        if not is_utf8(data):
+            raise NoQuickFix(
+                "I can't read `pack.mcmeta`. It isn't saved as UTF-8 text. Save it again with UTF-8 encoding.")
+        if not ask("I found an error in JSON format of `pack.mcmeta`. I can reset it."):
+            return
+        json = DEFAULT_JSON
+        is_dirty = True
+    if 'pack' not in json:
+        if not ask("I can't find `pack` keyword in `pack.mcmeta`. I can reset it."):
+            return
+        json = DEFAULT_JSON
+        is_dirty = True
+    if "pack_format" not in json['pack']:
+        if ask(f"I can't find `pack_format` keyword in `pack.mcmeta`. I can set it to {DEFAULTS['pack_format']}"):
+            json['pack']['pack_format'] = DEFAULTS['pack_format']
+            is_dirty = True
+    elif type(json['pack']['pack_format']) != int:
+        if ask(f"`pack_format` in `pack.mcmeta` should be a whole number. I can set it to {DEFAULTS['pack_format']}"):
+            json['pack']['pack_format'] = DEFAULTS['pack_format']
+            is_dirty = True
+
+    if "description" not in json['pack']:
+        if ask(f"I can't find `description` keyword in `pack.mcmeta`. I can set it to {DEFAULTS['description']}"):
+            json['pack']['description'] = DEFAULTS['description']
+            is_dirty = True
+    if is_dirty:
+        write_json(pack_mcmeta, json)
+
+
+def join_path(parent: str, name: str) -> str:
+    return parent+os.sep+name
+
+
+def rename_file(old_str: str, new_str: str) -> None:
+    if os.path.exists(new_str) and not os.path.samefile(old_str, new_str):
+        raise NoQuickFix(
+            f"I can't rename `{os.path.basename(old_str)}` to `{os.path.basename(new_str)}` because that file already exists. Remove one of them and try again.")
+    os.rename(old_str, new_str)
+
+
+def fix_suffix(file_str: str, suffix: str) -> str:
+    name = os.path.basename(file_str)
+    stem = name[:name.rfind('.')] if '.' in name[1:] else name
+    new_str = file_str[:len(file_str)-len(name)] + \
+        (stem if stem.endswith(suffix) else stem+suffix)
+    rename_file(file_str, new_str)
+    return new_str
+
+
+def check_non_json(file_str: str) -> str:
+    if not file_str.endswith('.json'):
+        if ask(f"I found `{os.path.basename(file_str)}` file which isn't json file. Would you like me to change that?"):
+            return fix_suffix(file_str, '.json')
+    return file_str
+
+
+def check_non_png(file_str: str) -> str:
+    if not file_str.endswith('.png'):
+        if ask(f"I found `{os.path.basename(file_str)}` file which isn't png file. Would you like me to change that?"):
+            return fix_suffix(file_str, '.png')
+    return file_str
 
 
 def check_json_error(file_path: Path) -> dict[str, str]:
-    with file_path.open('r') as file:
-        try:
-            json = load(file)
-        except JSONDecodeError as error:
+    data = file_path.read_bytes()
+    try:
+        return _loads(data)
+    except ValueError as error:
+        if not is_utf8(data):
             raise NoQuickFix(
-                f"I can't read {file_path.resolve().as_posix()} json file. It's malformed. Here's the error:\n{error}")
-    return json
+                f"I can't read {display_path(file_path)} json file. It isn't saved as UTF-8 text. Save it again with UTF-8 encoding.")
+        raise NoQuickFix(
+            f"I can't read {display_path(file_path)} json file. It's malformed. Here's the error:\n{error}")
 
 
-def check_vanilla_json(file_path: Path, json: dict[str, str]) -> str:
+def check_vanilla_json(file_path: Path, json: dict[str, str]) -> list[str]:
     if "overrides" not in json:
         raise NoQuickFix(
-            f"I can't find `overrides` key in {file_path.resolve().as_posix()}.")
+            f"I can't find `overrides` key in {display_path(file_path)}.")
     if not isinstance(json["overrides"], list):
         raise NoQuickFix(
-            f"`overrides` value is not an array(list) in {file_path.resolve().as_posix()}.")
+            f"`overrides` value is not an array(list) in {display_path(file_path)}.")
+    models = []
+    invalid_indexes = []
+    is_sorted = True
+    is_dirty = False
+    last_custom_model_data = None
     try:
-        json["overrides"][0]["predicate"]["custom_model_data"]
-        custom_model_data = [override["predicate"]["custom_model_data"]
-                             for override in json["overrides"]]
+        for override in json["overrides"]:
+            if not isinstance(override, dict) or not isinstance(override["predicate"], dict):
+                raise NoQuickFix(
+                    f"Every override and its `predicate` should be JSON in {display_path(file_path)}.")
+            number = override["predicate"]["custom_model_data"]
+            if type(number) not in (int, float):
+                raise NoQuickFix(
+                    f"custom_model_data({number!r}) is not a number in {display_path(file_path)}.")
+            if number == last_custom_model_data:
+                raise NoQuickFix(
+                    f"Duplicate custom_model_data({number}) in {display_path(file_path)}.")
+            if last_custom_model_data is not None and number < last_custom_model_data:
+                is_sorted = False
+            last_custom_model_data = number
+
+            model = override["model"]
+            if not isinstance(model, str):
+                raise NoQuickFix(
+                    f"`model` value({model!r}) is not a string in {display_path(file_path)}.")
+            if model.endswith('.json') or _fix_name(model)[0]:
+                invalid_indexes.append(len(models))
+            models.append(model)
     except KeyError as error:
         raise NoQuickFix(
-            f"{error.args[0]} isn't in {file_path.resolve().as_posix()}")
-
-    last_custom_model_data = -1
-    for number in custom_model_data:
-        if number == last_custom_model_data:
-            raise NoQuickFix(
-                f"Duplicate custom_model_data({number}) in {file_path.resolve().as_posix()}.")
-
-        last_custom_model_data = number
-    sorted_overrides = sorted(
-        json["overrides"], key=lambda x: x["predicate"]["custom_model_data"])
-    if json["overrides"] != sorted_overrides and ask(f"custom_model_data is not in ascending order in {file_path.resolve().as_posix()}. I can rearrange them, would you like me to?"):
-        json["overrides"] = sorted_overrides
-        with file_path.open('w+') as file:
-            dump(json, file, indent=INDENT_LV)
-
-    for index in range(len(json["overrides"])):
-        if json["overrides"][index]["model"].endswith('.json'):
-            if ask(f'{json["overrides"][index]["model"]} is not a valid texture because it ends with `.json` in {file_path.resolve().as_posix()}\nLet me remove that for you?'):
-                json["overrides"][index]["model"] = json["overrides"][index]["model"][:-5]
-        json["overrides"][index]["model"] = fix_name(
-            json["overrides"][index]["model"])[1]
-
-    return [override["model"]
-            for override in json["overrides"]]
+            f"{error.args[0]} isn't in {display_path(file_path)}")
+
+    for index in invalid_indexes:
+        override = json["overrides"][index]
+        model = override["model"]
+        if model.endswith('.json'):
+            if ask(f'{model} is not a valid texture because it ends with `.json` in {display_path(file_path)}\nLet me remove that for you?'):
+                model = model[:-5]
+        model = fix_name(model)[1]
+        if model != override["model"]:
+            override["model"] = model
+            models[index] = model
+            is_dirty = True
+
+    if not is_sorted and ask(f"custom_model_data is not in ascending order in {display_path(file_path)}. I can rearrange them, would you like me to?"):
+        json["overrides"].sort(
+            key=lambda x: x["predicate"]["custom_model_data"])
+        is_dirty = True
+    if is_dirty:
+        write_json(file_path, json)
+    return models
 
 
 def clear_png(file_path: Path, texture: str) -> str:
     if texture.endswith('.png'):
-        if ask(f"{texture} is not a valid texture because it ends with `.png` in {file_path.resolve().as_posix()}\nLet me remove that for you?"):
+        if ask(f"{texture} is not a valid texture because it ends with `.png` in {display_path(file_path)}\nLet me remove that for you?"):
             texture = texture[:-4]
     return fix_name(texture)[1]
 
 
+def has_missing_texture(json: dict) -> bool:
+    if orjson is not None:
+        return b'"#missing' in orjson.dumps(json)
+    stack = [json]
+    while stack:
+        value = stack.pop()
+        for child in (value.values() if type(value) is dict else value):
+            child_type = type(child)
+            if child_type is str:
+                if child.startswith('#missing'):
+                    return True
+            elif child_type is dict or child_type is list:
+                stack.append(child)
+    return False
+
+
 def check_custom_json(file_path: Path, json: dict[str, str]) -> str:
     if not isinstance(json["textures"], dict):
         raise NoQuickFix(
-            f"value of `textures` is not JSON in {file_path.resolve().as_posix()}\nYou did not export it from BlockBench properly. (Or any other tool you are using)")
+            f"value of `textures` is not JSON in {display_path(file_path)}\nYou did not export it from BlockBench properly. (Or any other tool you are using)")
     if "elements" not in json:
         raise NoQuickFix(
-            f"`elements` key not found in {file_path.resolve().as_posix()}\nYou did not export it from BlockBench properly. (Or any other tool you are using)")
-    if '"#missing' in dumps(json):
+            f"`elements` key not found in {display_path(file_path)}\nYou did not export it from BlockBench properly. (Or any other tool you are using)")
+    if not all(isinstance(texture, str) for texture in json["textures"].values()):
+        raise NoQuickFix(
+            f"Every value of `textures` should be a string in {display_path(file_path)}\nYou did not export it from BlockBench properly. (Or any other tool you are using)")
+    if has_missing_texture(json):
         raise NoQuickFix(
-            f"`#missing` texture found in {file_path.resolve().as_posix()}\nYou did not give texture file to BlockBench properly.")
+            f"`#missing` texture found in {display_path(file_path)}\nYou did not give texture file to BlockBench properly.")
 
     fixed_textures = {key: clear_png(file_path, texture)
                       for key, texture in json["textures"].items()}
-    if json["textures"] != fixed_textures and ask(f"Invalid textures file found in {file_path.resolve().as_posix()} I think I can fix it."):
+    if json["textures"] != fixed_textures and ask(f"Invalid textures file found in {display_path(file_path)} I think I can fix it."):
         json["textures"] = fixed_textures
-        with file_path.open('w+') as file:
-            dump(json, file, indent=INDENT_LV)
+        write_json(file_path, json)
     return json["textures"].values()
 
 
 def is_vanilla_json(file_path: Path, json: dict[str, str]) -> bool:
     if "textures" not in json:
         raise ResourcePackError(
-            f"I can't find `textures` key in {file_path.resolve().as_posix()}. You did not export it from BlockBench properly. (Or any other tool you are using)")
+            f"I can't find `textures` key in {display_path(file_path)}. You did not export it from BlockBench properly. (Or any other tool you are using)")
     if "parent" in json and "layer0" in json["textures"]:
         if json["textures"]["layer0"] != f"item/{file_path.stem}" and json["textures"]["layer0"] != f"minecraft:item/{file_path.stem}":
-            if ask(f'Incorrect layer0 for vanilla json in {file_path.resolve().as_posix()} Expected `item/{file_path.stem}` got `{json["textures"]["layer0"]}`\nIf this is not a vanilla item then something is terribly wrong.'):
+            if ask(f'Incorrect layer0 for vanilla json in {display_path(file_path)} Expected `item/{file_path.stem}` got `{json["textures"]["layer0"]}`\nIf this is not a vanilla item then something is terribly wrong.'):
                 json["textures"]["layer0"] = f"item/{file_path.stem}"
-                with file_path.open('w+') as file:
-                    dump(json, file, indent=INDENT_LV)
+                write_json(file_path, json)
         return True
     return False
 
 
+def walk_files(root: Path) -> Iterator[str]:
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        # List the directory before yielding, callers may rename files in it
+        with os.scandir(directory) as iterator:
+            entries = list(iterator)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file() and not entry.name.endswith(TEMP_SUFFIX):
+                yield entry.path
+
+
+def relative_posix(root: str, file_str: str) -> str:
+    return file_str[len(root)+1:].replace(os.sep, '/')
+
+
+def split_stem(relative: str) -> tuple[str, str]:
+    parent, _, name = relative.rpartition('/')
+    return (parent or '.', name.rpartition('.')[0] or name)
+
+
+def check_texture_file(root: str, texture_root: str, file_str: str) -> tuple[str, str]:
+    file_str = check_non_png(file_str)
+    relative = relative_posix(texture_root, file_str)
+    is_new, new_name = fix_name(TEXTURE_PREFIX+relative)
+    if is_new:
+        rename_file(file_str, join_path(root, new_name))
+        relative = new_name[len(TEXTURE_PREFIX):]
+    return split_stem(relative)
+
+
 def check_files(path: Path) -> None:
     model_dir = path/'assets'/'minecraft'/'models'
     item_dir = model_dir/'item'
@@ -214,43 +355,47 @@ def check_files(path: Path) -> None:
         raise ResourcePackError(
             "`assets/minecraft/textures` not found. I don't know how to handle this. Something isn't right.")
 
-    set_of_model_file: set[str] = set()
+    root = str(path)
+    texture_root = str(texture_dir)
+    item_root = str(item_dir)
+
+    model_entries: list[tuple[str, str]] = []
     set_of_model_key: set[str] = set()
 
-    set_of_textures_file: set[str] = set()
     set_of_textures_key: set[str] = set()
 
-    for file_path in texture_dir.glob('**/*'):
-        if not file_path.is_file():
-            continue
-        check_non_png(file_path)
-        is_new, new_name = fix_name(
-            file_path.relative_to(path).as_posix())
-        if is_new:
-            file_path = file_path.rename(path/new_name)
-        set_of_textures_file.add(file_path.relative_to(
-            texture_dir).parent.as_posix()+'/'+file_path.stem)
-
-    for file_path in item_dir.glob('**/*'):
-        if not file_path.is_file():
-            continue
-        check_non_json(file_path)
+    texture_entries = [check_texture_file(root, texture_root, file_str)
+                       for file_str in walk_files(texture_dir)]
+
+    for file_str in walk_files(item_dir):
+        file_str = check_non_json(file_str)
+        file_path = Path(file_str)
         json = check_json_error(file_path)
 
-        is_new, new_name = fix_name(
-            file_path.relative_to(path).as_posix())
+        relative = ITEM_PREFIX+relative_posix(item_root, file_str)
+        is_new, new_name = fix_name(relative)
         if is_new:
-            file_path = file_path.rename(path/new_name)
+            new_str = join_path(root, new_name)
+            rename_file(file_str, new_str)
+            file_str = new_str
+            file_path = Path(file_str)
+            relative = new_name
 
         if is_vanilla_json(file_path, json):
-            for model in check_vanilla_json(file_path, json):
-                set_of_model_key.add(model)
+            set_of_model_key.update(
+                map(sys.intern, check_vanilla_json(file_path, json)))
         else:
-            set_of_model_file.add(file_path.relative_to(
-                model_dir).parent.as_posix()+'/'+file_path.stem)
-            for texture in check_custom_json(file_path, json):
-                set_of_textures_key.add(texture)
+            model_entries.append(split_stem(relative[len(MODEL_PREFIX):]))
+            set_of_textures_key.update(
+                map(sys.intern, check_custom_json(file_path, json)))
+
+    set_of_model_file = {sys.intern(f"{parent}/{stem}")
+                         for parent, stem in model_entries}
+    set_of_textures_file = {sys.intern(f"{parent}/{stem}")
+                            for parent, stem in texture_entries}
 
+    if set_of_model_key == set_of_model_file and set_of_textures_key == set_of_textures_file:
+        return
     strings = []
     if (diff := set_of_model_key-set_of_model_file):
         strings.append(
@@ -329,6 +474,7 @@ def diagnose(path: Path):
         getpass("Press enter to try again...")
         diagnose(path)
     except Exception as error:
+        import traceback
         print(BOT_NAME+"My creator messed up again. Send him this:\n")
         traceback.print_exc()
         getpass("Press enter to exit...")